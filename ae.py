@@ -7,10 +7,12 @@ import torch
 import torch.nn.functional as F
 from einops import rearrange
 from torch import Tensor, nn
+from torch.utils.checkpoint import checkpoint
 
 
 def swish(x: Tensor) -> Tensor:
-    return x * torch.sigmoid(x)
+    # single fused kernel instead of a sigmoid followed by a multiply
+    return F.silu(x)
 
 
 class AttnBlock(nn.Module):
@@ -71,8 +73,14 @@ class ResnetBlock(nn.Module):
             self.nin_shortcut = nn.Conv2d(
                 in_channels, out_channels, kernel_size=1, stride=1, padding=0
             )
+        self.use_checkpoint = False
 
     def forward(self, x):
+        if self.use_checkpoint and self.training:
+            return checkpoint(self._forward_impl, x, use_reentrant=False)
+        return self._forward_impl(x)
+
+    def _forward_impl(self, x):
         h = x
         h = self.norm1(h)
         h = swish(h)
@@ -99,16 +107,34 @@ class Downsample(nn.Module):
         return x
 
 
+def _subpixel_taps(w: Tensor, dim: int) -> tuple[Tensor, Tensor]:
+    # Along one axis, a 3-tap kernel applied to a nearest-x2 upsampled signal
+    # reads the low-res neighbours (-1, 0, 0) for even outputs and (0, 0, +1)
+    # for odd ones, i.e. low-res 3-tap kernels [a, b + c, 0] and [0, a + b, c].
+    a, b, c = w.unbind(dim)
+    zero = torch.zeros_like(a)
+    return torch.stack([a, b + c, zero], dim), torch.stack([zero, a + b, c], dim)
+
+
 class Upsample(nn.Module):
     def __init__(self, in_channels: int):
         super().__init__()
         self.conv = nn.Conv2d(
             in_channels, in_channels, kernel_size=3, stride=1, padding=1
         )
+        self.pixel_shuffle = nn.PixelShuffle(2)
 
     def forward(self, x: Tensor):
-        x = nn.functional.interpolate(x, scale_factor=2.0, mode="nearest")
-        x = self.conv(x)
+        # Same result as nearest-x2 interpolation followed by self.conv, but the
+        # conv runs on the low-res input and emits the four sub-pixel phases,
+        # so the 4x larger upsampled input is never materialized.
+        rows = _subpixel_taps(self.conv.weight, -2)
+        weight = torch.stack(
+            [phase for row in rows for phase in _subpixel_taps(row, -1)], dim=1
+        ).flatten(0, 1)
+        bias = self.conv.bias.repeat_interleave(4)
+        x = F.conv2d(x, weight, bias, stride=1, padding=1)
+        x = self.pixel_shuffle(x)
         return x
 
 
@@ -121,6 +147,7 @@ class Encoder(nn.Module):
         ch_mult: list[int],
         num_res_blocks: int,
         z_channels: int,
+        use_checkpoint: bool = False,
     ):
         super().__init__()
         self.ch = ch
@@ -161,6 +188,11 @@ class Encoder(nn.Module):
         self.conv_out = nn.Conv2d(
             block_in, z_channels, kernel_size=3, stride=1, padding=1
         )
+        # full-resolution blocks hold most of the activation memory and are
+        # cheap to recompute, so only they are checkpointed
+        if use_checkpoint:
+            for block in self.down[0].block:
+                block.use_checkpoint = True
 
     def forward(self, x: Tensor) -> Tensor:
         h = self.conv_in(x)
@@ -190,6 +222,7 @@ class Decoder(nn.Module):
         in_channels: int,
         resolution: int,
         z_channels: int,
+        use_checkpoint: bool = False,
     ):
         super().__init__()
         self.ch = ch
@@ -227,6 +260,9 @@ class Decoder(nn.Module):
             num_groups=32, num_channels=block_in, eps=1e-6, affine=True
         )
         self.conv_out = nn.Conv2d(block_in, out_ch, kernel_size=3, stride=1, padding=1)
+        if use_checkpoint:
+            for block in self.up[0].block:
+                block.use_checkpoint = True
 
     def forward(self, z: Tensor) -> Tensor:
         h = self.conv_in(z)
@@ -263,7 +299,15 @@ class DiagonalGaussian(nn.Module):
 
 class VAE(nn.Module):
     def __init__(
-        self, resolution, in_channels, ch, out_ch, ch_mult, num_res_blocks, z_channels
+        self,
+        resolution,
+        in_channels,
+        ch,
+        out_ch,
+        ch_mult,
+        num_res_blocks,
+        z_channels,
+        use_checkpoint=False,
     ):
         super().__init__()
         self.encoder = Encoder(
@@ -273,6 +317,7 @@ class VAE(nn.Module):
             ch_mult=ch_mult,
             num_res_blocks=num_res_blocks,
             z_channels=z_channels,
+            use_checkpoint=use_checkpoint,
         )
         self.decoder = Decoder(
             resolution=resolution,
@@ -282,6 +327,7 @@ class VAE(nn.Module):
             ch_mult=ch_mult,
             num_res_blocks=num_res_blocks,
             z_channels=z_channels,
+            use_checkpoint=use_checkpoint,
         )
         self.reg = DiagonalGaussian()
 
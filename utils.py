@@ -1,60 +1,79 @@
-from collections import namedtuple
+import functools
+import os
 
 import torch
 import torch.nn as nn
 from torchvision import models
 
+VGG_LPIPS_URL = "https://heibox.uni-heidelberg.de/seafhttp/files/9535cbee-6558-4c0c-8743-78f5e56ea75e/vgg.pth"
+
+_shared_lpips = None
+
+
+@functools.lru_cache(maxsize=1)
+def _load_pretrained(path="vgg.pth"):
+    # cached so rebuilding LPIPS doesn't hit the disk (or the network) again
+    if not os.path.exists(path):
+        print(f"{path} not found, downloading...")
+        torch.hub.download_url_to_file(VGG_LPIPS_URL, path, progress=False)
+    return torch.load(path, map_location=torch.device("cpu"))
+
 
 class LPIPS(nn.Module):
     # Learned perceptual metric
-    def __init__(self, use_dropout=True):
+    def __init__(self, use_dropout=True, dtype=torch.bfloat16):
         super().__init__()
         self.scaling_layer = ScalingLayer()
         self.chns = [64, 128, 256, 512, 512]  # vg16 features
-        self.net = vgg16(pretrained=True, requires_grad=False)
+        self.net = vgg16(pretrained=True, requires_grad=False).to(
+            memory_format=torch.channels_last
+        )
         self.lin0 = NetLinLayer(self.chns[0], use_dropout=use_dropout)
         self.lin1 = NetLinLayer(self.chns[1], use_dropout=use_dropout)
         self.lin2 = NetLinLayer(self.chns[2], use_dropout=use_dropout)
         self.lin3 = NetLinLayer(self.chns[3], use_dropout=use_dropout)
         self.lin4 = NetLinLayer(self.chns[4], use_dropout=use_dropout)
         self.load_from_pretrained()
+        # the lin heads are bias-free 1x1 convs, i.e. a weighted channel sum, so
+        # keep just their [1, C, 1, 1] weights and drop the modules
+        for kk in range(len(self.chns)):
+            lin = getattr(self, f"lin{kk}")
+            self.register_buffer(f"w{kk}", lin.model[-1].weight.detach().clone())
+            delattr(self, f"lin{kk}")
+        # the VGG trunk is stored in `dtype` (bf16 by default); the lin weights
+        # stay fp32 for the final weighted sum
+        self.net.to(dtype)
         for param in self.parameters():
             param.requires_grad = False
+        # frozen metric, always evaluated without dropout
+        self.eval()
 
     def load_from_pretrained(self, name="vgg_lpips"):
-        try:
-            data = torch.load("vgg.pth", map_location=torch.device("cpu"))
-        except:
-            print("Failed to load vgg.pth, downloading...")
-            os.system(
-                "wget https://heibox.uni-heidelberg.de/seafhttp/files/9535cbee-6558-4c0c-8743-78f5e56ea75e/vgg.pth"
-            )
-            data = torch.load("vgg.pth", map_location=torch.device("cpu"))
-
         self.load_state_dict(
-            data,
+            _load_pretrained(),
             strict=False,
         )
 
+    @classmethod
+    def shared(cls):
+        # one process-wide instance, so callers don't each hold a copy of VGG16
+        global _shared_lpips
+        if _shared_lpips is None:
+            _shared_lpips = cls()
+        return _shared_lpips
+
     def forward(self, input, target):
-        in0_input, in1_input = (self.scaling_layer(input), self.scaling_layer(target))
-        outs0, outs1 = self.net(in0_input), self.net(in1_input)
-        feats0, feats1, diffs = {}, {}, {}
-        lins = [self.lin0, self.lin1, self.lin2, self.lin3, self.lin4]
-        for kk in range(len(self.chns)):
-            feats0[kk], feats1[kk] = normalize_tensor(outs0[kk]), normalize_tensor(
-                outs1[kk]
-            )
-            diffs[kk] = (feats0[kk] - feats1[kk]) ** 2
-
-        res = [
-            spatial_average(lins[kk].model(diffs[kk]), keepdim=True)
-            for kk in range(len(self.chns))
-        ]
-        val = res[0]
-        for l in range(1, len(self.chns)):
-            val += res[l]
-        return val
+        # both images go through the trunk as one batch and are split afterwards
+        B = input.shape[0]
+        both = self.scaling_layer(torch.cat([input, target], dim=0))
+        # follow the trunk's current dtype so .float()/.half() on LPIPS keep working
+        dtype = self.net.slices[0][0].weight.dtype
+        both = both.to(dtype=dtype, memory_format=torch.channels_last)
+        # no inference_mode here: the loss still has to backprop into `input`
+        outs = self.net(both)
+        outs0, outs1 = [o[:B] for o in outs], [o[B:] for o in outs]
+        weights = [self.w0, self.w1, self.w2, self.w3, self.w4]
+        return _score(outs0, outs1, weights)
 
 
 class ScalingLayer(nn.Module):
@@ -66,9 +85,15 @@ class ScalingLayer(nn.Module):
         self.register_buffer(
             "scale", torch.Tensor([0.458, 0.448, 0.450])[None, :, None, None]
         )
+        # (inp - shift) / scale as a single fused multiply-add; derived constants
+        # are not persisted so checkpoints keep the original shift/scale keys
+        self.register_buffer("inv_scale", 1.0 / self.scale, persistent=False)
+        self.register_buffer(
+            "neg_shift_times_inv_scale", -self.shift / self.scale, persistent=False
+        )
 
     def forward(self, inp):
-        return (inp - self.shift) / self.scale
+        return torch.addcmul(self.neg_shift_times_inv_scale, inp, self.inv_scale)
 
 
 class NetLinLayer(nn.Module):
@@ -92,61 +117,82 @@ class NetLinLayer(nn.Module):
 class vgg16(torch.nn.Module):
     def __init__(self, requires_grad=False, pretrained=True):
         super(vgg16, self).__init__()
-        vgg_pretrained_features = models.vgg16(pretrained=pretrained).features
-        self.slice1 = torch.nn.Sequential()
-        self.slice2 = torch.nn.Sequential()
-        self.slice3 = torch.nn.Sequential()
-        self.slice4 = torch.nn.Sequential()
-        self.slice5 = torch.nn.Sequential()
-        self.N_slices = 5
-        for x in range(4):
-            self.slice1.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(4, 9):
-            self.slice2.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(9, 16):
-            self.slice3.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(16, 23):
-            self.slice4.add_module(str(x), vgg_pretrained_features[x])
-        for x in range(23, 30):
-            self.slice5.add_module(str(x), vgg_pretrained_features[x])
+        vgg_pretrained_features = vgg16_features(pretrained=pretrained)
+        # relu1_2, relu2_2, relu3_3, relu4_3, relu5_3
+        bounds = [0, 4, 9, 16, 23, 30]
+        self.slices = nn.ModuleList(
+            nn.Sequential(*vgg_pretrained_features[start:end])
+            for start, end in zip(bounds[:-1], bounds[1:])
+        )
+        self.N_slices = len(self.slices)
         if not requires_grad:
             for param in self.parameters():
                 param.requires_grad = False
 
     def forward(self, X):
-        h = self.slice1(X)
-        h_relu1_2 = h
-        h = self.slice2(h)
-        h_relu2_2 = h
-        h = self.slice3(h)
-        h_relu3_3 = h
-        h = self.slice4(h)
-        h_relu4_3 = h
-        h = self.slice5(h)
-        h_relu5_3 = h
-        vgg_outputs = namedtuple(
-            "VggOutputs", ["relu1_2", "relu2_2", "relu3_3", "relu4_3", "relu5_3"]
+        outs = []
+        h = X
+        for vgg_slice in self.slices:
+            h = vgg_slice(h)
+            outs.append(h)
+        return outs
+
+
+def vgg16_features(pretrained=True):
+    # Only the conv trunk is ever used, so skip building (and randomly
+    # initializing) the ~120M parameter classifier head of models.vgg16.
+    # make_layers / cfgs are undocumented internals of torchvision.models.vgg,
+    # assumed to be what models.vgg16 itself builds `.features` from, with
+    # cfgs["D"] as the VGG16 layout (true for the VGG16_Weights API, 0.13+).
+    # If that ever drifts, the strict load_state_dict below fails loudly.
+    features = models.vgg.make_layers(models.vgg.cfgs["D"])
+    if pretrained:
+        state_dict = models.VGG16_Weights.IMAGENET1K_V1.get_state_dict(progress=True)
+        features.load_state_dict(
+            {
+                k[len("features.") :]: v
+                for k, v in state_dict.items()
+                if k.startswith("features.")
+            }
         )
-        out = vgg_outputs(h_relu1_2, h_relu2_2, h_relu3_3, h_relu4_3, h_relu5_3)
-        return out
+    return features
 
 
 def normalize_tensor(x, eps=1e-10):
-    norm_factor = torch.sqrt(torch.sum(x**2, dim=1, keepdim=True))
-    return x / (norm_factor + eps)
+    # x / (||x|| + eps) as a multiply by rsqrt; eps stays on the scale of the norm
+    return x * torch.rsqrt(x.pow(2).sum(1, keepdim=True).add_(eps * eps))
 
 
 def spatial_average(x, keepdim=True):
     return x.mean([2, 3], keepdim=keepdim)
 
 
+# no CUDA graphs here: returned scores must outlive the next call, and callers
+# that want graphs (the trainer) compile the whole LPIPS module themselves
+@torch.compile(fullgraph=True)
+def _score(outs0, outs1, weights, eps=1e-10):
+    # Everything after the VGG trunk is memory-bound, so it is compiled into one
+    # fused region. The bias-free 1x1 lin convs are just a weighted channel sum.
+
+    # The normalized features are only referenced inside the comprehension, so
+    # they can be freed as soon as their squared difference exists.
+    diffs = [
+        (normalize_tensor(o0.float(), eps) - normalize_tensor(o1.float(), eps)).pow_(2)
+        for o0, o1 in zip(outs0, outs1)
+    ]
+    val = 0
+    for diff, weight in zip(diffs, weights):
+        # running sum inside the compiled region: no Python-side list of
+        # partials and no separate add kernels to combine them afterwards
+        val = val + spatial_average((diff * weight).sum(1, keepdim=True), keepdim=True)
+    return val
+
+
 class PatchDiscriminator(nn.Module):
     def __init__(self):
         super(PatchDiscriminator, self).__init__()
         self.scaling_layer = ScalingLayer()
-        _vgg = models.vgg16(pretrained=True)
-
-        self.features = _vgg.features[:16]
+        self.features = vgg16_features(pretrained=True)[:16]
 
         self.binary_classifier = nn.Sequential(
             nn.Conv2d(256, 1, kernel_size=1, stride=1, padding=0, bias=False),
@@ -17,6 +17,7 @@ from transformers import get_cosine_schedule_with_warmup
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
 
 import wandb
 from ae import VAE
@@ -209,6 +210,11 @@ def cleanup():
 )
 @click.option("--load_path", type=str, default=None, help="Path to load the model from")
 @click.option("--do_clamp", is_flag=True, help="Whether to clamp the latent codes")
+@click.option(
+    "--use_checkpoint",
+    is_flag=True,
+    help="Whether to use gradient checkpointing on the full-resolution VAE blocks",
+)
 def train_ddp(
     dataset_url,
     test_dataset_url,
@@ -228,6 +234,7 @@ def train_ddp(
     evaluate_every_n_steps,
     load_path,
     do_clamp,
+    use_checkpoint,
 ):
 
     # fix random seed
@@ -285,9 +292,11 @@ def train_ddp(
         ch_mult=[int(x) for x in vae_ch_mult.split(",")],
         num_res_blocks=vae_num_res_blocks,
         z_channels=vae_z_channels,
+        use_checkpoint=use_checkpoint,
     ).cuda()
+    vae = vae.to(memory_format=torch.channels_last)
 
-    discriminator = PatchDiscriminator().cuda()
+    discriminator = PatchDiscriminator().cuda().to(memory_format=torch.channels_last)
     discriminator.requires_grad_(True)
 
     vae = DDP(vae, device_ids=[ddp_rank])
@@ -301,6 +310,13 @@ def train_ddp(
 
     discriminator = DDP(discriminator, device_ids=[ddp_rank])
 
+    # default mode (no cudagraphs, no autotuning): real_preds is still read after
+    # later discriminator calls, and the D pass (2B) and G pass (B) use different
+    # batch sizes, so the second shape recompiles with a dynamic batch dimension
+    discriminator.module.features = torch.compile(
+        discriminator.module.features, fullgraph=False
+    )
+
     # context
     ctx = torch.amp.autocast(device_type="cuda", dtype=torch.bfloat16)
 
@@ -326,7 +342,10 @@ def train_ddp(
         betas=(0.9, 0.95),
     )
 
-    lpips = LPIPS().cuda()
+    # fixed input shapes every step, so let CUDA graphs replay the whole metric
+    lpips = torch.compile(
+        LPIPS.shared().cuda(), fullgraph=False, mode="reduce-overhead"
+    )
 
     dataloader = create_dataloader(
         dataset_url, batch_size, num_workers=4, do_shuffle=True
@@ -362,7 +381,7 @@ def train_ddp(
     for epoch in range(num_epochs):
         for i, real_images in enumerate(dataloader):
 
-            real_images = real_images[0].to(device)
+            real_images = real_images[0].to(device, memory_format=torch.channels_last)
             z = vae.module.encoder(real_images)
 
             # z distribution
@@ -407,8 +426,12 @@ def train_ddp(
                 break
 
             if do_ganloss:
-                real_preds = discriminator(real_images)
-                fake_preds = discriminator(reconstructed.detach())
+                # real and fake share one discriminator pass
+                with ctx:
+                    preds = discriminator(
+                        torch.cat([real_images, reconstructed.detach()], dim=0)
+                    ).float()
+                real_preds, fake_preds = preds.chunk(2, dim=0)
                 d_loss, avg_real_logits, avg_fake_logits = gan_disc_loss(
                     real_preds, fake_preds
                 )
@@ -429,7 +452,8 @@ def train_ddp(
             # gan loss
             if do_ganloss and global_step >= 20:
                 recon_for_gan = gradnorm(reconstructed)
-                fake_preds = discriminator(recon_for_gan)
+                with ctx:
+                    fake_preds = discriminator(recon_for_gan).float()
                 real_preds_const = real_preds.clone().detach()
                 # loss where (real > fake + 0.01)
                 g_gan_loss = (real_preds_const - fake_preds - 0.1).relu().mean()
@@ -534,7 +558,9 @@ def train_ddp(
                     all_reconstructed_test = []
 
                     for test_images in test_dataloader:
-                        test_images = test_images[0].to(device)
+                        test_images = test_images[0].to(
+                            device, memory_format=torch.channels_last
+                        )
                         z = vae.module.encoder(test_images)
 
                         if do_clamp: